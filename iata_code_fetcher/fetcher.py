@@ -3,16 +3,26 @@ This module contains functionality to fetch and process IATA codes from the IATA
 for both carrier and airport codes, processing the data, and saving it in JSONL format.
 """
 
-import json
+import argparse
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
 from string import ascii_uppercase, digits
 from itertools import product
-from typing import Generator, List, Dict
+from typing import Generator, List, Dict, Optional, Set, Tuple
 from enum import Enum
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import logging
-from time import sleep
-from bs4 import BeautifulSoup
-import requests
-from requests.exceptions import RequestException
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import os
+import queue
+import random
+import time
+import aiohttp
+from lxml import etree
+import orjson
+import zstandard
 
 # Constants
 BASE_URL: str = (
@@ -24,12 +34,28 @@ CARRIER_FILE: str = "carrier_data_full.jsonl"
 AIRPORT_FILE: str = "airport_data_full.jsonl"
 # Frequency of processing status updates
 REPORT_FREQUENCY: int = 100  # report every 100 codes
-MAX_RETRIES: int = 3
-RETRY_DELAY: int = 15  # seconds
+COMPRESSED_SUFFIX: str = ".zst"  # appended to the output file name when it is zstd-compressed
+COMPRESSION_LEVEL: int = 3
+CHECKPOINT_SUFFIX: str = ".done"  # sidecar file next to the output listing the codes already fetched
+CHECKPOINT_FREQUENCY: int = 100  # record completed codes every 100 codes
+CHECKPOINT_MAX_AGE: int = 24 * 3600  # seconds, an older checkpoint is left from a past run and is not resumed
+MAX_RETRIES: int = 5
+RETRY_DELAY: float = 5.0  # seconds, doubled after every failed attempt
+MAX_RETRY_DELAY: float = 120.0  # seconds, upper bound on a single wait, including one asked for by Retry-After
+RETRY_STATUSES: frozenset = frozenset({429, 500, 502, 503, 504})  # transient HTTP errors worth retrying
 TIMEOUT: int = 20  # seconds
+MAX_CONCURRENCY: int = 50  # requests in flight at once
+DNS_CACHE_TTL: int = 3600  # seconds, every request goes to the same host
+KEEPALIVE_TIMEOUT: int = 75  # seconds an idle pooled connection is kept open
+PARSE_WORKERS: int = os.cpu_count() or 1  # parser processes, one per CPU core
+QUEUE_SIZE: int = 200  # items buffered between the fetch, parse and write stages
+WRITE_BUFFER_SIZE: int = 1 << 20  # bytes buffered before the output file is written to
+TABLE_COLUMNS: int = 3  # both result tables have three columns
+TABLE_MARKER: bytes = b"datatable"  # present in the raw HTML only when there are results
+# Matches the results table by its class token, so that other classes next to it do not hide it
+TABLE_XPATH: str = ".//table[contains(concat(' ', normalize-space(@class), ' '), ' datatable ')]"
 
-# Configure Logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+LOG_FORMAT: str = "%(asctime)s - %(levelname)s - %(message)s"
 
 
 class CodeType(Enum):
@@ -41,87 +67,361 @@ class CodeType(Enum):
     AIRPORT = 2
 
 
-def generate_codes(length: int) -> Generator[str, None, None]:
+# Per code type settings, resolved once instead of on every request. The search code is the last URL parameter, so
+# the request URL is just the prefix with the code appended.
+URL_PREFIXES: Dict[CodeType, str] = {
+    CodeType.CARRIER: BASE_URL.format(block=CARRIER_BLOCK, type="airline", code=""),
+    CodeType.AIRPORT: BASE_URL.format(block=AIRPORT_BLOCK, type="airport", code=""),
+}
+FILE_PATHS: Dict[CodeType, str] = {CodeType.CARRIER: CARRIER_FILE, CodeType.AIRPORT: AIRPORT_FILE}
+CODE_LENGTHS: Dict[CodeType, int] = {CodeType.CARRIER: 2, CodeType.AIRPORT: 3}
+# Carrier designators may contain digits (e.g. "T2"), airport location codes are letters only
+CODE_ALPHABETS: Dict[CodeType, str] = {CodeType.CARRIER: ascii_uppercase + digits, CodeType.AIRPORT: ascii_uppercase}
+# Headers of the results table, which are also the keys of the saved rows
+TABLE_HEADERS: Dict[CodeType, Tuple[str, str, str]] = {
+    CodeType.CARRIER: ("Company name", "Country / Territory", "2-letter code"),
+    CodeType.AIRPORT: ("City Name", "Airport Name", "3-letter location code"),
+}
+
+
+class UnexpectedHeadersError(ValueError):
+    """
+    Raised when a results table does not have the headers expected for the code type, e.g. after a site change.
+    """
+
+
+def generate_codes(length: int, alphabet: str = ascii_uppercase + digits) -> Generator[str, None, None]:
     """
     Generate all possible combinations of IATA codes of a given length.
 
     :param length: Length of the IATA code (2 for carrier, 3 for airport).
+    :param alphabet: Characters a code may consist of.
     :return: Generator of code strings.
     """
-    return ("".join(letters) for letters in product(ascii_uppercase + digits, repeat=length))
+    return ("".join(letters) for letters in product(alphabet, repeat=length))
 
 
-def fetch_and_process_data(code: str, code_type: CodeType) -> List[Dict[str, str]]:
+def parse_table(body: bytes, code_type: CodeType, encoding: Optional[str] = None) -> List[Dict[str, str]]:
     """
-    Fetch and process data from the IATA site based on the code and type.
+    Parse the results table out of an IATA search response.
+
+    :param body: Raw HTML of the response.
+    :param code_type: The type of the code (CodeType.CARRIER or CodeType.AIRPORT).
+    :param encoding: Charset of the response, from its Content-Type header. Without it, libxml2 guesses.
+    :return: List of dictionaries, one per table row, keyed by the table headers.
+    """
+    # Most codes have no record, so rule those out with a substring check before building a tree
+    if TABLE_MARKER not in body:
+        raise ValueError("No record found")
+
+    root = etree.HTML(body, etree.HTMLParser(encoding=encoding))
+    tables = root.xpath(TABLE_XPATH) if root is not None else []
+
+    if not tables:
+        raise ValueError("No record found")
+
+    table = tables[0]
+
+    # The header row is made of <td> cells too, so the first TABLE_COLUMNS cells are the headers. They are only
+    # checked against the known ones, which are reused as the keys of every row.
+    cells = ["".join(cell.itertext()).strip() for cell in table.iter("td")]
+    headers = TABLE_HEADERS[code_type]
+    if tuple(cells[:TABLE_COLUMNS]) != headers:
+        raise UnexpectedHeadersError(f"Unexpected table headers {cells[:TABLE_COLUMNS]}")
+
+    first, second, third = headers
+    return [
+        {first: cells[i], second: cells[i + 1], third: cells[i + 2]}
+        for i in range(TABLE_COLUMNS, len(cells) - TABLE_COLUMNS + 1, TABLE_COLUMNS)
+    ]
+
+
+def load_checkpoint(checkpoint_path: str, file_path: str) -> Set[str]:
+    """
+    Load the codes recorded as already fetched by an interrupted run.
+
+    A checkpoint whose output file is missing, or which is older than CHECKPOINT_MAX_AGE, is stale and is deleted.
+
+    :param checkpoint_path: Path to the checkpoint file, one code per line.
+    :param file_path: Path to the output file the checkpoint describes.
+    :return: Set of completed codes, empty if there is no usable checkpoint.
+    """
+    if not os.path.exists(checkpoint_path):
+        return set()
+
+    if not os.path.exists(file_path) or time.time() - os.path.getmtime(checkpoint_path) > CHECKPOINT_MAX_AGE:
+        logging.warning("Ignoring stale checkpoint %s, fetching every code again.", checkpoint_path)
+        os.remove(checkpoint_path)
+        return set()
+
+    with open(checkpoint_path, "r", encoding="UTF-8") as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+def remaining_codes(code_type: CodeType, file_path: str, checkpoint_path: str) -> Generator[str, None, None]:
+    """
+    Generate the codes of the given type that are not recorded as done in the checkpoint.
 
+    :param code_type: The type of the code (CodeType.CARRIER or CodeType.AIRPORT).
+    :param file_path: Path to the output file.
+    :param checkpoint_path: Path to the checkpoint file.
+    :return: Generator of code strings.
+    """
+    done = load_checkpoint(checkpoint_path, file_path)
+    if done:
+        logging.info("Resuming from %s, skipping %d %s codes.", checkpoint_path, len(done), code_type.name.lower())
+
+    return (code for code in generate_codes(CODE_LENGTHS[code_type], CODE_ALPHABETS[code_type]) if code not in done)
+
+
+def retry_after(error: aiohttp.ClientResponseError) -> float:
+    """
+    Get the number of seconds the server asked to wait before retrying, from the Retry-After header of its response.
+
+    :param error: The HTTP error raised for the response.
+    :return: Seconds to wait, 0 if the header is missing or invalid.
+    """
+    value = error.headers.get("Retry-After") if error.headers else None
+    if not value:
+        return 0.0
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def fetch_page(session: aiohttp.ClientSession, code: str, code_type: CodeType) -> Tuple[bytes, str]:
+    """
+    Fetch the raw search results page from the IATA site for the code and type, retrying transient errors.
+
+    :param session: The HTTP session shared by the whole sweep.
     :param code: The IATA code.
     :param code_type: The type of the code (CodeType.CARRIER or CodeType.AIRPORT).
-    :return: List of dictionaries.
+    :return: Raw HTML of the response and its charset.
     """
-    url = BASE_URL.format(
-        block=CARRIER_BLOCK if code_type == CodeType.CARRIER else AIRPORT_BLOCK,
-        type="airline" if code_type == CodeType.CARRIER else "airport",
-        code=code,
-    )
+    url = URL_PREFIXES[code_type] + code
+    error: Optional[Exception] = None
 
     for attempt in range(MAX_RETRIES):
+        wait = 0.0
         try:
-            response = requests.get(url, timeout=TIMEOUT)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
-            table = soup.find("table", {"class": "datatable"})
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=TIMEOUT)) as response:
+                response.raise_for_status()
+                body = await response.read()
+                return body, response.get_encoding()
 
-            if not table:
-                raise ValueError("No record found")
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES:
+                raise
+            error = e
+            wait = retry_after(e)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
 
-            headers = [th.text.strip() for th in table.find_all("td")]
-            rows = []
-            for row in table.find("tbody").find_all("tr"):
-                cols = [col.text.strip() for col in row.find_all("td")]
-                row_data = dict(zip(headers, cols))
-                rows.append(row_data)
-
-            return rows
-
-        except RequestException as e:
-            if attempt < MAX_RETRIES - 1:
-                logging.warning(
-                    "Request failed for %s. Retrying in %d seconds... (Attempt %d/%d)",
-                    code,
-                    RETRY_DELAY,
-                    attempt + 1,
-                    MAX_RETRIES,
-                )
-                sleep(RETRY_DELAY)
-            else:
-                raise RequestException(f"Request failed after {MAX_RETRIES} attempts: {str(e)}") from e
+        if attempt < MAX_RETRIES - 1:
+            # Exponential backoff with jitter, so concurrent retries do not hit the server in lockstep
+            delay = min(max(RETRY_DELAY * 2**attempt + random.uniform(0, RETRY_DELAY), wait), MAX_RETRY_DELAY)
+            logging.warning(
+                "Request failed for %s. Retrying in %.1f seconds... (Attempt %d/%d)",
+                code,
+                delay,
+                attempt + 1,
+                MAX_RETRIES,
+            )
+            await asyncio.sleep(delay)
 
-    return []
+    raise aiohttp.ClientError(f"Request failed after {MAX_RETRIES} attempts: {str(error)}") from error
 
 
-def process_and_save_data(code_type: CodeType) -> None:
+async def fetch_and_process_data(
+    session: aiohttp.ClientSession, code: str, code_type: CodeType
+) -> List[Dict[str, str]]:
     """
-    Process and save data for the given code type.
+    Fetch and process data from the IATA site based on the code and type.
 
+    :param session: The HTTP session shared by the whole sweep.
+    :param code: The IATA code.
     :param code_type: The type of the code (CodeType.CARRIER or CodeType.AIRPORT).
+    :return: List of dictionaries.
     """
-    processed: int = 0
-    file_path = CARRIER_FILE if code_type == CodeType.CARRIER else AIRPORT_FILE
-    for code in generate_codes(2 if code_type == CodeType.CARRIER else 3):
+    body, encoding = await fetch_page(session, code, code_type)
+    return parse_table(body, code_type, encoding)
+
+
+def create_connector() -> aiohttp.TCPConnector:
+    """
+    Create the connection pool for a sweep, with one kept-alive connection per in-flight request.
+
+    :return: Connector for the sweep's aiohttp.ClientSession.
+    """
+    return aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY,
+        limit_per_host=MAX_CONCURRENCY,
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+
+
+async def parse_pages(
+    page_queue: asyncio.Queue, row_queue: asyncio.Queue, code_type: CodeType, executor: Executor
+) -> int:
+    """
+    Parser stage of the pipeline: parse (code, page) items until a None sentinel arrives.
+
+    :param page_queue: Queue of (code, raw HTML, charset) items to parse.
+    :param row_queue: Queue receiving (code, rows) items.
+    :param code_type: The type of the codes (CodeType.CARRIER or CodeType.AIRPORT).
+    :param executor: Executor to run parse_table in.
+    :return: Number of pages with unexpected table headers.
+    """
+    loop = asyncio.get_running_loop()
+    failed = 0
+    while (item := await page_queue.get()) is not None:
+        code, body, encoding = item
         try:
-            result = fetch_and_process_data(code, code_type)
-            with open(file_path, "a", encoding="UTF-8") as file:
-                for item in result:
-                    file.write(json.dumps(item) + "\n")
-        except RequestException as e:
+            if TABLE_MARKER in body:
+                rows = await loop.run_in_executor(executor, parse_table, body, code_type, encoding)
+            else:
+                # parse_table rejects the page straight away, no need for a round trip through the executor
+                rows = parse_table(body, code_type, encoding)
+        except UnexpectedHeadersError as e:
             logging.error("For %s: %s", code, e)
+            failed += 1
+            continue
         except ValueError as e:
             logging.info("For %s, %s", code, e)
+            rows = []
+        await row_queue.put((code, rows))
+
+    return failed
+
+
+async def write_rows(row_queue: asyncio.Queue, file_path: str, checkpoint_path: str, compress: bool = False) -> None:
+    """
+    Writer stage of the pipeline: append (code, rows) items to the output until a None sentinel arrives.
+
+    :param row_queue: Queue of (code, rows) items to write.
+    :param file_path: Path to the output JSONL file.
+    :param checkpoint_path: Path to the checkpoint file.
+    :param compress: Whether to write zstd-compressed JSONL.
+    """
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL) if compress else None
+    completed: List[str] = []
+    lines: List[bytes] = []
+
+    with open(file_path, "ab", buffering=WRITE_BUFFER_SIZE) as file, open(
+        checkpoint_path, "a", encoding="UTF-8"
+    ) as checkpoint:
+
+        def save_batch() -> None:
+            data = b"".join(lines)
+            if data:
+                file.write(compressor.compress(data) if compressor else data)
+            # The rows must reach the output file before their codes are marked as done
+            file.flush()
+            checkpoint.write("".join(code + "\n" for code in completed))
+            checkpoint.flush()
+            completed.clear()
+            lines.clear()
+
+        while (item := await row_queue.get()) is not None:
+            code, rows = item
+            lines.extend(orjson.dumps(row) + b"\n" for row in rows)
+            completed.append(code)
+            if len(completed) >= CHECKPOINT_FREQUENCY:
+                save_batch()
+        save_batch()
+
+
+async def run_stages(
+    fetchers: List[asyncio.Task],
+    parsers: List[asyncio.Task],
+    writer: asyncio.Task,
+    page_queue: asyncio.Queue,
+    row_queue: asyncio.Queue,
+) -> None:
+    """
+    Run the pipeline stages to completion, cancelling them all if one fails.
+
+    :param fetchers: Fetcher tasks, which finish on their own once all codes are taken.
+    :param parsers: Parser tasks, reading from page_queue.
+    :param writer: Writer task, reading from row_queue.
+    :param page_queue: Queue between the fetchers and the parsers.
+    :param row_queue: Queue between the parsers and the writer.
+    """
+
+    async def shut_down() -> None:
+        await asyncio.gather(*fetchers)
+        for _ in parsers:
+            await page_queue.put(None)
+        await asyncio.gather(*parsers)
+        await row_queue.put(None)
+        await writer
 
-        processed += 1
-        if processed % REPORT_FREQUENCY == 0:
-            logging.info("Processed %s %s codes so far...", processed, code_type.name.lower())
+    tasks = [*fetchers, *parsers, writer, asyncio.create_task(shut_down())]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+async def process_and_save_data(code_type: CodeType, compress: bool = False) -> None:
+    """
+    Process and save data for the given code type.
+
+    :param code_type: The type of the code (CodeType.CARRIER or CodeType.AIRPORT).
+    :param compress: Whether to write zstd-compressed JSONL, to the output file name with COMPRESSED_SUFFIX appended.
+    """
+    processed: int = 0
+    failed: int = 0
+    file_path = FILE_PATHS[code_type] + (COMPRESSED_SUFFIX if compress else "")
+    checkpoint_path = file_path + CHECKPOINT_SUFFIX
+    codes = remaining_codes(code_type, file_path, checkpoint_path)
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    row_queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async def fetcher(session: aiohttp.ClientSession) -> None:
+        nonlocal processed, failed
+        # All fetchers share one generator, each taking the next code as soon as it is free
+        for code in codes:
+            try:
+                await page_queue.put((code, *await fetch_page(session, code, code_type)))
+            except aiohttp.ClientError as e:
+                logging.error("For %s: %s", code, e)
+                failed += 1
+
+            processed += 1
+            if processed % REPORT_FREQUENCY == 0:
+                logging.info("Processed %s %s codes so far...", processed, code_type.name.lower())
+
+    # Workers are spawned rather than forked, as forking copies the running event loop and the logging thread
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")) as executor:
+        async with aiohttp.ClientSession(connector=create_connector()) as session:
+            parsers = [
+                asyncio.create_task(parse_pages(page_queue, row_queue, code_type, executor))
+                for _ in range(PARSE_WORKERS)
+            ]
+            await run_stages(
+                [asyncio.create_task(fetcher(session)) for _ in range(MAX_CONCURRENCY)],
+                parsers,
+                asyncio.create_task(write_rows(row_queue, file_path, checkpoint_path, compress)),
+                page_queue,
+                row_queue,
+            )
+
+    failed += sum(parser.result() for parser in parsers)
+
+    if failed:
+        logging.warning("%d %s codes failed. Run again to retry them.", failed, code_type.name.lower())
+    elif os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
     logging.info(
         "Data extraction for %ss completed. Results are saved in %s.",
@@ -130,9 +430,43 @@ def process_and_save_data(code_type: CodeType) -> None:
     )
 
 
+def configure_logging() -> QueueListener:
+    """
+    Configure logging through a queue, so that the event loop never blocks on writing log records to stderr.
+
+    :return: The started listener, to be stopped once logging is done.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+def main():
+    """
+    Main function to fetch and save the carrier and airport data.
+    """
+    parser = argparse.ArgumentParser(description="Fetch IATA carrier and airport codes.")
+    parser.add_argument(
+        "--compress", action="store_true", help=f"write zstd-compressed JSONL files ({COMPRESSED_SUFFIX} suffix)"
+    )
+    args = parser.parse_args()
+
+    listener = configure_logging()
+    try:
+        asyncio.run(process_and_save_data(CodeType.CARRIER, args.compress))
+        asyncio.run(process_and_save_data(CodeType.AIRPORT, args.compress))
+    finally:
+        listener.stop()
+
+
 if __name__ == "__main__":
-    process_and_save_data(CodeType.CARRIER)
-    process_and_save_data(CodeType.AIRPORT)
+    main()
 
 
 # Example response for:
@@ -2,32 +2,67 @@
 Module for processing airport and carrier data from JSONL files.
 """
 
+import argparse
+import io
 import sys
 import os
 import polars as pl
+import zstandard
 
+# Fetched column names mapped to output names, which are also the deduplication key and sort order
+AIRPORT_SCHEMA = {"3-letter location code": "iata", "City Name": "city_name", "Airport Name": "airport_name"}
+CARRIER_SCHEMA = {
+    "2-letter code": "iata",
+    "Country / Territory": "country_or_territory",
+    "Company name": "company_name",
+}
 
-def process_airport_data(file_path):
+
+def scan_jsonl(file_path):
     """
-    Process airport data from a JSONL file.
+    Lazily read a JSONL file. Files ending in .zst are decompressed in memory first, as polars cannot read zstd JSONL.
 
     Args:
-        file_path (str): Path to the JSONL file containing airport data.
+        file_path (str): Path to the JSONL file, optionally zstd-compressed.
 
     Returns:
-        polars.DataFrame: Processed airport data.
+        polars.LazyFrame: Query reading the file.
     """
-    df = pl.read_ndjson(file_path)
+    if not file_path.endswith(".zst"):
+        return pl.scan_ndjson(file_path)
 
-    df_deduplicated = df.unique()
+    with open(file_path, "rb") as file:
+        with zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True) as reader:
+            return pl.read_ndjson(io.BytesIO(reader.read())).lazy()
 
-    result = df_deduplicated.rename(
-        {"3-letter location code": "iata", "City Name": "city_name", "Airport Name": "airport_name"}
-    )
 
-    result = result.sort(["iata", "city_name", "airport_name"])
+def process_data(file_path, schema):
+    """
+    Process fetched data from a JSONL file: rename its columns, then deduplicate and sort the rows.
+
+    Args:
+        file_path (str): Path to the JSONL file, optionally zstd-compressed.
+        schema (dict): Mapping of the fetched column names to the output names. The output columns are both the
+            deduplication key and the sort order, in the order given.
+
+    Returns:
+        polars.LazyFrame: Query producing the processed data.
+    """
+    columns = list(schema.values())
+    return scan_jsonl(file_path).rename(schema).unique(subset=columns, maintain_order=False).sort(columns)
+
+
+def process_airport_data(file_path):
+    """
+    Process airport data from a JSONL file.
+
+    Args:
+        file_path (str): Path to the JSONL file containing airport data, optionally zstd-compressed.
 
-    return result
+    Returns:
+        polars.LazyFrame: Query producing the processed airport data.
+    """
+    return process_data(file_path, AIRPORT_SCHEMA)
 
 
 def process_carrier_data(file_path):
@@ -35,53 +70,64 @@ def process_carrier_data(file_path):
     Process carrier data from a JSONL file.
 
     Args:
-        file_path (str): Path to the JSONL file containing carrier data.
+        file_path (str): Path to the JSONL file containing carrier data, optionally zstd-compressed.
 
     Returns:
-        polars.DataFrame: Processed carrier data.
+        polars.LazyFrame: Query producing the processed carrier data.
     """
-    df = pl.read_ndjson(file_path)
-
-    df_deduplicated = df.unique()
+    return process_data(file_path, CARRIER_SCHEMA)
 
-    result = df_deduplicated.rename(
-        {
-            "2-letter code": "iata",
-            "Country / Territory": "country_or_territory",
-            "Company name": "company_name",
-        }
-    )
 
-    result = result.sort(["iata", "country_or_territory", "company_name"])
+def save_data(result, output_path, output_format):
+    """
+    Write the result of a query to a file, streaming it when the installed polars can run the query that way.
 
-    return result
+    Args:
+        result (polars.LazyFrame): Query producing the data to write.
+        output_path (str): Path to the output file.
+        output_format (str): "jsonl" or "parquet", the latter written with zstd compression.
+    """
+    try:
+        # Streams the input through the query straight into the output file, without materializing it in memory
+        if output_format == "parquet":
+            result.sink_parquet(output_path, compression="zstd", statistics=True)
+        else:
+            result.sink_ndjson(output_path)
+    except pl.exceptions.InvalidOperationError:
+        # Older polars releases cannot stream deduplication and sorting, so collect the result first
+        data = result.collect()
+        if output_format == "parquet":
+            data.write_parquet(output_path, compression="zstd", statistics=True)
+        else:
+            data.write_ndjson(output_path)
 
 
 def main():
     """
     Main function to process the JSONL file based on the given mode (air or carrier).
     """
-    if len(sys.argv) != 3:
-        print("Usage: python script.py <air|carrier> <path_to_jsonl_file>")
-        sys.exit(1)
-
-    mode = sys.argv[1]
-    file_path = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Deduplicate and sort fetched IATA data.")
+    parser.add_argument("mode", choices=["air", "carrier"], help="kind of data in the file")
+    parser.add_argument("file_path", help="path to the JSONL file, optionally zstd-compressed (.zst)")
+    parser.add_argument(
+        "--format",
+        choices=["jsonl", "parquet"],
+        default="jsonl",
+        help="output format, parquet is written with zstd compression (default: jsonl)",
+    )
+    args = parser.parse_args()
 
-    if not os.path.exists(file_path):
-        print(f"File {file_path} does not exist.")
+    if not os.path.exists(args.file_path):
+        print(f"File {args.file_path} does not exist.")
         sys.exit(1)
 
-    if mode == "air":
-        result = process_airport_data(file_path)
-    elif mode == "carrier":
-        result = process_carrier_data(file_path)
+    if args.mode == "air":
+        result = process_airport_data(args.file_path)
     else:
-        print("Invalid mode. Use 'air' or 'carrier'.")
-        sys.exit(1)
+        result = process_carrier_data(args.file_path)
 
-    output_path = os.path.splitext(file_path)[0] + "_processed.jsonl"
-    result.write_ndjson(output_path)
+    output_path = f"{os.path.splitext(args.file_path.removesuffix('.zst'))[0]}_processed.{args.format}"
+    save_data(result, output_path, args.format)
     print(f"Processed data saved to {output_path}")
 
 
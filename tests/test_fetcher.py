@@ -3,15 +3,26 @@ This module contains unit tests for the iata_code_fetcher.fetcher module, verify
 and integration points, with a focus on the fetch_and_process_data and process_and_save_data functions.
 """
 
+import asyncio
+import os
 from string import ascii_uppercase, digits
-from unittest.mock import patch, mock_open
+from unittest.mock import AsyncMock, MagicMock, patch, mock_open
+import aiohttp
 import pytest
-from requests.exceptions import RequestException
+import zstandard
 from iata_code_fetcher.fetcher import (
     generate_codes,
     fetch_and_process_data,
+    parse_table,
     process_and_save_data,
     CodeType,
+    CHECKPOINT_FREQUENCY,
+    CHECKPOINT_MAX_AGE,
+    MAX_RETRIES,
+    CODE_ALPHABETS,
+    FILE_PATHS,
+    MAX_CONCURRENCY,
+    WRITE_BUFFER_SIZE,
 )
 
 
@@ -70,15 +81,29 @@ def mock_airport_response():
     """
 
 
-@patch("requests.get")
-def test_fetch_and_process_data_carrier(mock_get, carrier_response_mock):
+def make_session(text, encoding="utf-8"):
+    """
+    Builds a mock aiohttp session whose GET requests respond with the given HTML, served in the given charset.
+    """
+    response = MagicMock()
+    response.read = AsyncMock(return_value=text.encode(encoding) if isinstance(text, str) else text)
+    response.get_encoding.return_value = encoding
+    session = MagicMock()
+    session.get.return_value.__aenter__.return_value = response
+    return session
+
+
+def test_fetch_and_process_data_carrier(carrier_response_mock):
     """
     Test fetch_and_process_data function with a mocked carrier code response to ensure it parses data correctly.
     """
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.text = carrier_response_mock
+    session = make_session(carrier_response_mock)
+
+    data = asyncio.run(fetch_and_process_data(session, "AA", CodeType.CARRIER))
 
-    data = fetch_and_process_data("AA", CodeType.CARRIER)
+    assert session.get.call_args.args[0] == (
+        "https://www.iata.org/PublicationDetails/Search/?currentBlock=314383&currentPage=12572&airline.search=AA"
+    )
 
     expected_data = [
         {
@@ -96,15 +121,17 @@ def test_fetch_and_process_data_carrier(mock_get, carrier_response_mock):
     assert data == expected_data
 
 
-@patch("requests.get")
-def test_fetch_and_process_data_airport(mock_get, airport_response_mock):
+def test_fetch_and_process_data_airport(airport_response_mock):
     """
     Test fetch_and_process_data function with a mocked airport code response to ensure it correctly parses data.
     """
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.text = airport_response_mock
+    session = make_session(airport_response_mock)
 
-    data = fetch_and_process_data("AAA", CodeType.AIRPORT)
+    data = asyncio.run(fetch_and_process_data(session, "AAA", CodeType.AIRPORT))
+
+    assert session.get.call_args.args[0] == (
+        "https://www.iata.org/PublicationDetails/Search/?currentBlock=314384&currentPage=12572&airport.search=AAA"
+    )
 
     expected_data = [
         {
@@ -117,56 +144,264 @@ def test_fetch_and_process_data_airport(mock_get, airport_response_mock):
     assert data == expected_data
 
 
-@patch("requests.get")
-def test_fetch_and_process_data_error(mock_get):
+@pytest.mark.parametrize("text", ["", "<html><body><p>No results</p></body></html>"])
+def test_fetch_and_process_data_no_record(text):
+    """
+    Test fetch_and_process_data function with a response that has no results table.
+    """
+    session = make_session(text)
+
+    with pytest.raises(ValueError, match="No record found"):
+        _ = asyncio.run(fetch_and_process_data(session, "ZZ", CodeType.CARRIER))
+
+
+@pytest.mark.parametrize(
+    "body, city",
+    [
+        ("<td>São Paulo</td>".encode(), "São Paulo"),
+        # A byte that is not valid in the declared charset is replaced, not decoded as Latin-1
+        (b"<td>S\xe3o Paulo</td>", "S\ufffdo Paulo"),
+    ],
+)
+def test_fetch_and_process_data_non_ascii(body, city):
+    """
+    Test fetch_and_process_data function decodes the page with the charset of the response.
+    """
+    page = (
+        b'<table class="datatable"><tr><td>City Name</td><td>Airport Name</td><td>3-letter location code</td></tr>'
+        b"<tr>" + body + b"<td>Guarulhos</td><td>GRU</td></tr></table>"
+    )
+    session = make_session(page)
+
+    data = asyncio.run(fetch_and_process_data(session, "GRU", CodeType.AIRPORT))
+
+    assert data == [{"City Name": city, "Airport Name": "Guarulhos", "3-letter location code": "GRU"}]
+
+
+def test_parse_table_extra_classes(airport_response_mock):
+    """
+    Test parse_table function finds the results table when it has other classes besides datatable.
+    """
+    body = airport_response_mock.replace('class="datatable"', 'class="datatable striped"').encode()
+
+    assert parse_table(body, CodeType.AIRPORT) == [
+        {"City Name": "Anaa", "Airport Name": "Anaa Airport", "3-letter location code": "AAA"}
+    ]
+
+
+def test_parse_table_unexpected_headers(airport_response_mock):
+    """
+    Test parse_table function rejects a table whose headers do not match the code type.
+    """
+    with pytest.raises(ValueError, match="Unexpected table headers"):
+        parse_table(airport_response_mock.encode(), CodeType.CARRIER)
+
+
+@patch("iata_code_fetcher.fetcher.RETRY_DELAY", 0)
+def test_fetch_and_process_data_error():
     """
     Test fetch_and_process_data function with network error.
     """
-    mock_get.side_effect = RequestException("Network error")
+    session = MagicMock()
+    session.get.side_effect = aiohttp.ClientError("Network error")
+
+    with pytest.raises(aiohttp.ClientError):
+        _ = asyncio.run(fetch_and_process_data(session, "AA", CodeType.CARRIER))
+
+    assert session.get.call_count == MAX_RETRIES
+
+
+@patch("iata_code_fetcher.fetcher.RETRY_DELAY", 0)
+@patch("asyncio.sleep", new_callable=AsyncMock)
+def test_fetch_and_process_data_retry_after(mock_sleep, carrier_response_mock):
+    """
+    Test fetch_and_process_data function waits as long as the Retry-After header of a throttled response asks.
+    """
+    session = make_session(carrier_response_mock)
+    response = session.get.return_value
+    session.get.side_effect = [
+        aiohttp.ClientResponseError(MagicMock(), (), status=429, headers={"Retry-After": "30"}),
+        response,
+    ]
+
+    data = asyncio.run(fetch_and_process_data(session, "AB", CodeType.CARRIER))
+
+    assert len(data) == 2
+    mock_sleep.assert_awaited_once_with(30.0)
+
+
+@patch("iata_code_fetcher.fetcher.RETRY_DELAY", 0)
+def test_fetch_and_process_data_client_error_not_retried():
+    """
+    Test fetch_and_process_data function does not retry HTTP errors that are not transient.
+    """
+    session = MagicMock()
+    session.get.side_effect = aiohttp.ClientResponseError(MagicMock(), (), status=404)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        _ = asyncio.run(fetch_and_process_data(session, "AA", CodeType.CARRIER))
 
-    with pytest.raises(RequestException):
-        _ = fetch_and_process_data("AA", CodeType.CARRIER)
+    assert session.get.call_count == 1
 
 
-@patch("builtins.open", new_callable=mock_open)
-@patch("requests.get")
-def test_process_and_save_data_carrier(mock_get, mock_file, carrier_response_mock):
+@patch("iata_code_fetcher.fetcher.open", new_callable=mock_open, create=True)
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_carrier(mock_session, mock_file, tmp_path, carrier_response_mock):
     """
     Test test_process_and_save_data_carrier function with a mocked carrier code.
     """
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.text = carrier_response_mock
+    mock_session.return_value.__aenter__.return_value = make_session(carrier_response_mock)
+    file_path = str(tmp_path / "carrier_data_full.jsonl")
 
-    with patch("time.sleep", return_value=None):
-        process_and_save_data(CodeType.CARRIER)
+    with patch.dict(FILE_PATHS, {CodeType.CARRIER: file_path}):
+        asyncio.run(process_and_save_data(CodeType.CARRIER))
 
-    mock_file.assert_called_with("carrier_data_full.jsonl", "a", encoding="UTF-8")
+    mock_session.assert_called_once()
+    assert mock_session.call_args.kwargs["connector"].limit == MAX_CONCURRENCY
+    mock_file.assert_any_call(file_path, "ab", buffering=WRITE_BUFFER_SIZE)
     mock_file().write.assert_any_call(
-        '{"Company name": "BONZA AVIATION PTY LTD", "Country / Territory": "Australia", "2-letter code": "AB"}\n'
-    )
-    mock_file().write.assert_any_call(
-        '{"Company name": "West Atlantic Sweden AB", "Country / Territory": "Sweden", "2-letter code": "T2"}\n'
+        (
+            b'{"Company name":"BONZA AVIATION PTY LTD","Country / Territory":"Australia","2-letter code":"AB"}\n'
+            b'{"Company name":"West Atlantic Sweden AB","Country / Territory":"Sweden","2-letter code":"T2"}\n'
+        )
+        * CHECKPOINT_FREQUENCY
     )
 
 
-@patch("builtins.open", new_callable=mock_open)
-@patch("requests.get")
-def test_process_and_save_data_airport(mock_get, mock_file, airport_response_mock):
+@patch("iata_code_fetcher.fetcher.open", new_callable=mock_open, create=True)
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_airport(mock_session, mock_file, tmp_path, airport_response_mock):
     """
     Test test_process_and_save_data_carrier function with a mocked airport code.
     """
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.text = airport_response_mock
+    mock_session.return_value.__aenter__.return_value = make_session(airport_response_mock)
+    file_path = str(tmp_path / "airport_data_full.jsonl")
 
-    with patch("time.sleep", return_value=None):
-        process_and_save_data(CodeType.AIRPORT)
+    # 5**3 codes are a full checkpoint batch and a partial one, without sweeping every airport code
+    with patch.dict(FILE_PATHS, {CodeType.AIRPORT: file_path}), patch.dict(CODE_ALPHABETS, {CodeType.AIRPORT: "ABCDE"}):
+        asyncio.run(process_and_save_data(CodeType.AIRPORT))
 
-    mock_file.assert_called_with("airport_data_full.jsonl", "a", encoding="UTF-8")
+    mock_file.assert_any_call(file_path, "ab", buffering=WRITE_BUFFER_SIZE)
+    mock_file().write.assert_any_call(
+        b'{"City Name":"Anaa","Airport Name":"Anaa Airport","3-letter location code":"AAA"}\n' * CHECKPOINT_FREQUENCY
+    )
     mock_file().write.assert_any_call(
-        '{"City Name": "Anaa", "Airport Name": "Anaa Airport", "3-letter location code": "AAA"}\n'
+        b'{"City Name":"Anaa","Airport Name":"Anaa Airport","3-letter location code":"AAA"}\n'
+        * (5**3 - CHECKPOINT_FREQUENCY)
     )
 
 
+@patch("iata_code_fetcher.fetcher.open", new_callable=mock_open, create=True)
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_no_records(mock_session, mock_file, tmp_path):
+    """
+    Test process_and_save_data function writes nothing when no code has a record.
+    """
+    mock_session.return_value.__aenter__.return_value = make_session("<html></html>")
+
+    with patch.dict(FILE_PATHS, {CodeType.CARRIER: str(tmp_path / "carrier_data_full.jsonl")}):
+        asyncio.run(process_and_save_data(CodeType.CARRIER))
+
+    # Only the checkpoint, which is written as text, receives anything
+    assert not any(isinstance(call.args[0], bytes) for call in mock_file().write.call_args_list)
+
+
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_resumes_from_checkpoint(mock_session, tmp_path, carrier_response_mock):
+    """
+    Test process_and_save_data function only fetches the codes missing from the checkpoint and removes it once done.
+    """
+    session = make_session(carrier_response_mock)
+    mock_session.return_value.__aenter__.return_value = session
+    file_path = tmp_path / "carrier_data_full.jsonl"
+    checkpoint_path = tmp_path / "carrier_data_full.jsonl.done"
+    file_path.write_bytes(b"")
+    checkpoint_path.write_text("".join(code + "\n" for code in generate_codes(2) if code != "T2"), encoding="UTF-8")
+
+    with patch.dict(FILE_PATHS, {CodeType.CARRIER: str(file_path)}):
+        asyncio.run(process_and_save_data(CodeType.CARRIER))
+
+    session.get.assert_called_once()
+    assert session.get.call_args.args[0].endswith("airline.search=T2")
+    assert len(file_path.read_bytes().splitlines()) == 2
+    assert not checkpoint_path.exists()
+
+
+@pytest.mark.parametrize("output_exists, age", [(False, 0), (True, CHECKPOINT_MAX_AGE + 60)])
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_ignores_stale_checkpoint(mock_session, output_exists, age, tmp_path):
+    """
+    Test process_and_save_data function fetches every code again when the output file was deleted or the checkpoint
+    is too old.
+    """
+    session = make_session("<html></html>")
+    mock_session.return_value.__aenter__.return_value = session
+    file_path = tmp_path / "carrier_data_full.jsonl"
+    checkpoint_path = tmp_path / "carrier_data_full.jsonl.done"
+    if output_exists:
+        file_path.write_bytes(b"")
+    checkpoint_path.write_text("".join(code + "\n" for code in generate_codes(2) if code != "T2"), encoding="UTF-8")
+    modified = checkpoint_path.stat().st_mtime - age
+    os.utime(checkpoint_path, (modified, modified))
+
+    with patch.dict(FILE_PATHS, {CodeType.CARRIER: str(file_path)}):
+        asyncio.run(process_and_save_data(CodeType.CARRIER))
+
+    assert session.get.call_count == 36**2
+    assert not checkpoint_path.exists()
+
+
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_unexpected_headers(mock_session, tmp_path, airport_response_mock):
+    """
+    Test process_and_save_data function neither writes nor checkpoints codes whose table headers are unexpected.
+    """
+    mock_session.return_value.__aenter__.return_value = make_session(airport_response_mock)
+    file_path = tmp_path / "carrier_data_full.jsonl"
+    checkpoint_path = tmp_path / "carrier_data_full.jsonl.done"
+
+    with patch.dict(FILE_PATHS, {CodeType.CARRIER: str(file_path)}):
+        asyncio.run(process_and_save_data(CodeType.CARRIER))
+
+    assert file_path.read_bytes() == b""
+    assert checkpoint_path.read_text(encoding="UTF-8") == ""
+
+
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_stage_failure(mock_session, tmp_path, carrier_response_mock):
+    """
+    Test process_and_save_data function raises, instead of hanging, when a pipeline stage dies.
+    """
+    mock_session.return_value.__aenter__.return_value = make_session(carrier_response_mock)
+
+    with patch.dict(FILE_PATHS, {CodeType.CARRIER: str(tmp_path / "carrier_data_full.jsonl")}), patch(
+        "orjson.dumps", side_effect=OSError("No space left on device")
+    ):
+        with pytest.raises(OSError, match="No space left on device"):
+            asyncio.run(asyncio.wait_for(process_and_save_data(CodeType.CARRIER), timeout=60))
+
+
+@patch("aiohttp.ClientSession")
+def test_process_and_save_data_compressed(mock_session, tmp_path, airport_response_mock):
+    """
+    Test process_and_save_data function writes zstd-compressed JSONL when asked to compress.
+    """
+    mock_session.return_value.__aenter__.return_value = make_session(airport_response_mock)
+    file_path = tmp_path / "airport_data_full.jsonl"
+
+    with patch.dict(FILE_PATHS, {CodeType.AIRPORT: str(file_path)}), patch.dict(
+        CODE_ALPHABETS, {CodeType.AIRPORT: "ABCDE"}
+    ):
+        asyncio.run(process_and_save_data(CodeType.AIRPORT, compress=True))
+
+    assert not file_path.exists()
+    with open(tmp_path / "airport_data_full.jsonl.zst", "rb") as file:
+        with zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True) as reader:
+            lines = reader.read().splitlines()
+    assert len(lines) == 5**3
+    assert set(lines) == {b'{"City Name":"Anaa","Airport Name":"Anaa Airport","3-letter location code":"AAA"}'}
+
+
 def test_generate_codes_for_two_letter_codes():
     """
     Test to ensure the function generates two-letter codes correctly,
@@ -223,5 +458,17 @@ def test_generate_codes_for_three_letter_codes():
     ), "All codes must consist of uppercase letters and digits"
 
 
+def test_generate_codes_with_letters_only_alphabet():
+    """
+    Test to ensure the function restricts codes to the given alphabet, as used for airport location codes.
+    """
+    codes = list(generate_codes(3, ascii_uppercase))
+
+    assert len(codes) == 26**3, "Only letter combinations should be generated"
+    assert codes[0] == "AAA", "The first code should be 'AAA'"
+    assert codes[-1] == "ZZZ", "The last code should be 'ZZZ'"
+    assert all(code.isalpha() for code in codes), "Codes must not contain digits"
+
+
 if __name__ == "__main__":
     pytest.main()
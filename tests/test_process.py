@@ -0,0 +1,110 @@
+"""
+This module contains unit tests for the iata_code_fetcher.process module, verifying the deduplication and sorting
+of fetched data, from plain and zstd-compressed JSONL, and the output files written by its command line.
+"""
+
+from unittest.mock import patch
+import orjson
+import polars as pl
+import pytest
+import zstandard
+from iata_code_fetcher.process import process_data, main, AIRPORT_SCHEMA
+
+# Fetched rows, in fetch order, with a duplicate as a resumed sweep may produce
+AIRPORT_ROWS = [
+    {"City Name": "Anaa", "Airport Name": "Anaa Airport", "3-letter location code": "AAA"},
+    {"City Name": "Aalborg", "Airport Name": "Aalborg", "3-letter location code": "AAL"},
+    {"City Name": "Anaa", "Airport Name": "Anaa Airport", "3-letter location code": "AAA"},
+    {"City Name": "Aachen", "Airport Name": "Aachen-Merzbrück", "3-letter location code": "AAH"},
+]
+EXPECTED_AIRPORTS = {
+    "iata": ["AAA", "AAH", "AAL"],
+    "city_name": ["Anaa", "Aachen", "Aalborg"],
+    "airport_name": ["Anaa Airport", "Aachen-Merzbrück", "Aalborg"],
+}
+
+
+def jsonl(rows):
+    """
+    Serialize rows as JSONL, the way the fetcher writes them.
+    """
+    return b"".join(orjson.dumps(row) + b"\n" for row in rows)
+
+
+@pytest.fixture(name="plain_path")
+def write_plain_file(tmp_path):
+    """
+    Provides a plain JSONL file of fetched airport rows.
+    """
+    path = tmp_path / "airport_data_full.jsonl"
+    path.write_bytes(jsonl(AIRPORT_ROWS))
+    return path
+
+
+@pytest.fixture(name="compressed_path")
+def write_compressed_file(tmp_path):
+    """
+    Provides the same airport rows zstd-compressed, one frame per batch as the fetcher writes them.
+    """
+    path = tmp_path / "airport_data_full.jsonl.zst"
+    compressor = zstandard.ZstdCompressor()
+    path.write_bytes(compressor.compress(jsonl(AIRPORT_ROWS[:2])) + compressor.compress(jsonl(AIRPORT_ROWS[2:])))
+    return path
+
+
+def test_process_data(plain_path):
+    """
+    Test process_data function returns a lazy query renaming, deduplicating and sorting the rows.
+    """
+    result = process_data(str(plain_path), AIRPORT_SCHEMA)
+
+    assert isinstance(result, pl.LazyFrame)
+    assert result.collect().to_dict(as_series=False) == EXPECTED_AIRPORTS
+
+
+def test_process_data_compressed(plain_path, compressed_path):
+    """
+    Test process_data function reads every frame of a multi-frame zstd file, with the same result as plain JSONL.
+    """
+    plain = process_data(str(plain_path), AIRPORT_SCHEMA).collect()
+    compressed = process_data(str(compressed_path), AIRPORT_SCHEMA).collect()
+
+    assert compressed.equals(plain)
+
+
+@pytest.mark.parametrize("input_name", ["plain_path", "compressed_path"])
+def test_main_parquet(input_name, request, tmp_path):
+    """
+    Test main function writes parquet next to the input, named after it without the .zst suffix.
+    """
+    input_path = request.getfixturevalue(input_name)
+
+    with patch("sys.argv", ["process.py", "air", str(input_path), "--format", "parquet"]):
+        main()
+
+    assert pl.read_parquet(tmp_path / "airport_data_full_processed.parquet").to_dict(as_series=False) == (
+        EXPECTED_AIRPORTS
+    )
+
+
+def test_main_jsonl(plain_path, tmp_path):
+    """
+    Test main function writes JSONL by default.
+    """
+    with patch("sys.argv", ["process.py", "air", str(plain_path)]):
+        main()
+
+    assert pl.read_ndjson(tmp_path / "airport_data_full_processed.jsonl").to_dict(as_series=False) == (
+        EXPECTED_AIRPORTS
+    )
+
+
+def test_main_missing_file(tmp_path):
+    """
+    Test main function exits with an error when the input file does not exist.
+    """
+    with patch("sys.argv", ["process.py", "air", str(tmp_path / "missing.jsonl")]):
+        with pytest.raises(SystemExit) as exit_info:
+            main()
+
+    assert exit_info.value.code == 1